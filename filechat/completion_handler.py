@@ -1,4 +1,5 @@
 import os
+import time
 import typing
 
 import dotenv
@@ -61,10 +62,24 @@ async def request_completion(
         http_client=http_client,
     )
 
+    start_time = time.perf_counter()
+    usage_record: dict[str, typing.Any] = {"model": config.get("model"), "retries": -1}
+
     async def try_func():
+        usage_record["retries"] += 1
+        # Reset the usage left over from a failed attempt
+        usage_record.update(
+            ttft=None, prompt_tokens=None, completion_tokens=None, cache_hit=None
+        )
+        attempt_start_time = time.perf_counter()
         response = await client.chat.completions.create(
             messages=messages,
             stream=True,
+            **(
+                {"stream_options": {"include_usage": True}}
+                if config.get("stream_include_usage", True)
+                else {}
+            ),
             **{
                 k: v
                 for k, v in config.items()
@@ -72,15 +87,34 @@ async def request_completion(
             },
         )
 
-        stream = (
-            chunk.choices[0].delta.content
-            async for chunk in response
-            if chunk.choices and chunk.choices[0].delta.content is not None
-        )
-        return await stream_handler(stream)
+        async def content_stream():
+            async for chunk in response:
+                if chunk.model:
+                    usage_record["model"] = chunk.model
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                    usage_record["prompt_tokens"] = usage.prompt_tokens
+                    usage_record["completion_tokens"] = usage.completion_tokens
+                    details = getattr(usage, "prompt_tokens_details", None)
+                    usage_record["cache_hit"] = bool(
+                        details and getattr(details, "cached_tokens", None)
+                    )
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    if usage_record["ttft"] is None:
+                        usage_record["ttft"] = time.perf_counter() - attempt_start_time
+                    yield chunk.choices[0].delta.content
 
-    return await utils.try_loop_async(
+        return await stream_handler(content_stream())
+
+    result = await utils.try_loop_async(
         try_func,
         raise_on_retry_exceed=False,
         **{k: v for k, v in config.items() if k in {"max_retries"}},
     )
+
+    usage_record["duration"] = time.perf_counter() - start_time
+    usage_record["success"] = result is not None
+    for handler in config.get("completion_usage_handlers", []):
+        handler(usage_record)
+
+    return result
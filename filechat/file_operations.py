@@ -1,10 +1,25 @@
+import gzip
+import json
+import os
 import re
 import typing
 
 import openai.types.chat
 import yaml
 
-from . import chat_format, markdown_formatter
+from . import app_config, chat_format, markdown_formatter, utils
+
+
+file_write_handlers: list[typing.Callable[[str], None]] = []
+
+
+def handle_file_write(file_path: str) -> None:
+    """
+    Call the file write handlers after the file has been written.
+    """
+
+    for handler in file_write_handlers:
+        handler(file_path)
 
 
 def get_section_pattern_for_roles(roles: typing.Iterable[str]) -> re.Pattern[str]:
@@ -24,6 +39,53 @@ def match_front_matter(text: str) -> re.Match[str] | None:
     return re.search(front_matter_pattern, text)
 
 
+def generate_archive_name(file_path: str) -> str:
+    """
+    Generate a unique archive name, so that an archive is never shared with another file.
+    """
+
+    return f"{os.path.basename(file_path)}.{utils.generate_uuid()}.archive.jsonl.gz"
+
+
+def get_archive_path(file_path: str, archive_name: str) -> str:
+    """
+    Return the path of an archive recorded in the file, relative to the directory of the file.
+    """
+
+    return os.path.join(os.path.dirname(file_path), archive_name)
+
+
+def match_archive_marker(text: str) -> re.Match[str] | None:
+    archive_marker_pattern = re.compile(
+        r"\A\n*<!-- filechat-archive: (\d+) earlier messages archived in \"([^\"\n]+)\" \((\d+) bytes\) -->(?:\n+|\Z)"
+    )
+    return re.search(archive_marker_pattern, text)
+
+
+def format_archive_marker(archive_name: str, count: int, size: int) -> str:
+    return f'<!-- filechat-archive: {count} earlier messages archived in "{archive_name}" ({size} bytes) -->'
+
+
+def load_archived_messages(archive_path: str, size: int) -> list[dict]:
+    """
+    Load the messages in the first `size` bytes of the archive, oldest first.
+
+    Bytes beyond `size` were written by an interrupted archiving or by a copy of the
+    file, and are ignored.
+    """
+
+    try:
+        with open(archive_path, "rb") as file:
+            data = file.read(size)
+        text = gzip.decompress(data).decode("utf-8")
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    except (OSError, EOFError, ValueError) as e:
+        utils.log_warning(
+            f"Failed to load archived messages from {archive_path}: {e}. Continuing without them."
+        )
+        return []
+
+
 def parse_file(file_path: str) -> tuple[dict, list[dict]]:
     """
     Parse the file containing configuration (optional) and messages and return the config and messages.
@@ -44,6 +106,11 @@ def parse_file(file_path: str) -> tuple[dict, list[dict]]:
             raise ValueError("Invalid config format. Expected a dictionary.")
         text = text[front_matter_match.end() :]
 
+    # Strip the archive marker, if any, so that it is not parsed as message content
+    archive_marker_match = match_archive_marker(text)
+    if archive_marker_match:
+        text = text[archive_marker_match.end() :]
+
     section_pattern = get_section_pattern_for_roles(chat_format.roles)
     section_matches = re.findall(section_pattern, text)
 
@@ -63,10 +130,32 @@ def parse_file(file_path: str) -> tuple[dict, list[dict]]:
             file_path,
             messages=[{"role": "user", "content": text.strip()}],
             config=config,
+            preamble=(
+                archive_marker_match.group(0).strip() if archive_marker_match else ""
+            ),
         )
         # Parse the file again
         return parse_file(file_path)
 
+    if archive_marker_match and config.get(
+        "archive_in_context", app_config.get("archive_in_context", True)
+    ):
+        # Archived messages come after the leading system messages kept in the file
+        leading_system_count = 0
+        while (
+            leading_system_count < len(messages)
+            and messages[leading_system_count]["role"] == "system"
+        ):
+            leading_system_count += 1
+        messages = (
+            messages[:leading_system_count]
+            + load_archived_messages(
+                get_archive_path(file_path, archive_marker_match.group(2)),
+                size=int(archive_marker_match.group(3)),
+            )
+            + messages[leading_system_count:]
+        )
+
     return config, messages
 
 
@@ -80,30 +169,36 @@ def format_file(file_path: str) -> None:
 
     with open(file_path, "w", encoding="utf-8") as file:
         file.write(markdown_formatter.format_text(text))
+    handle_file_write(file_path)
 
 
 def write_messages_to_file(
-    file_path: str, messages: list[dict], config: dict = {}
+    file_path: str, messages: list[dict], config: dict = {}, preamble: str = ""
 ) -> None:
     text = ""
     if config:
         text += f"---\n{yaml.dump(config).strip()}\n---\n\n"
+    if preamble:
+        text += f"{preamble}\n\n"
     text += "\n".join(
         f"# {chat_format.role_heading_map[message['role']]}\n\n{message['content']}\n"
         for message in messages
     )
     with open(file_path, "w", encoding="utf-8") as file:
         file.write(text)
+    handle_file_write(file_path)
 
 
 def append_heading_to_file(file_path: str, role: str) -> None:
     with open(file_path, "a", encoding="utf-8") as file:
         file.write(f"\n# {chat_format.role_heading_map[role]}\n\n")
+    handle_file_write(file_path)
 
 
 def append_token_to_file(file_path: str, text: str) -> None:
     with open(file_path, "a", encoding="utf-8") as file:
         file.write(text)
+    handle_file_write(file_path)
 
 
 def append_message_to_file(
@@ -113,6 +208,7 @@ def append_message_to_file(
         file.write(
             f"\n# {chat_format.role_heading_map[message.role]}\n\n{message.content}\n"
         )
+    handle_file_write(file_path)
 
 
 def remove_last_message_from_file(
@@ -139,3 +235,159 @@ def remove_last_message_from_file(
 
     with open(file_path, "w", encoding="utf-8") as file:
         file.write(text)
+    handle_file_write(file_path)
+
+
+def archive_old_messages(
+    file_path: str, max_turns: int | None = None, max_bytes: int | None = None
+) -> int:
+    """
+    Move older messages from the file to its compressed archive once the file exceeds
+    `max_turns` turns or `max_bytes` bytes, and return the number of messages archived.
+
+    Leading system messages and the last turn are always kept in the file. Trailing
+    empty messages are not counted as a turn.
+    """
+
+    if not max_turns and not max_bytes:
+        return 0
+
+    with open(file_path, "r", encoding="utf-8") as file:
+        text = file.read()
+
+    front_matter_match = match_front_matter(text)
+    front_matter = front_matter_match.group(0) if front_matter_match else ""
+    body = text[len(front_matter) :]
+
+    archive_marker_match = match_archive_marker(body)
+    if archive_marker_match:
+        archived_count = int(archive_marker_match.group(1))
+        archive_name = archive_marker_match.group(2)
+        archived_size = int(archive_marker_match.group(3))
+        body = body[archive_marker_match.end() :]
+    else:
+        archived_count = 0
+        archive_name = generate_archive_name(file_path)
+        archived_size = 0
+    archive_path = get_archive_path(file_path, archive_name)
+
+    section_pattern = get_section_pattern_for_roles(chat_format.roles)
+    section_matches = list(re.finditer(section_pattern, body))
+    roles = [chat_format.heading_role_map[str(m.group(1))] for m in section_matches]
+
+    first = 0
+    while first < len(roles) and roles[first] == "system":
+        first += 1
+    # Ignore trailing empty messages, which are not part of the last turn
+    last = len(roles)
+    while last > first and not str(section_matches[last - 1].group(2) or "").strip():
+        last -= 1
+    if first >= last:
+        return 0
+
+    # Each user message starts a new turn
+    turn_starts = [first] + [i for i in range(first + 1, last) if roles[i] == "user"]
+
+    turns_to_archive = 0
+    if max_turns and len(turn_starts) > max_turns:
+        turns_to_archive = len(turn_starts) - max_turns
+    turns_to_archive = min(turns_to_archive, len(turn_starts) - 1)
+    if max_bytes:
+        section_ends = [m.start() for m in section_matches[1:]] + [len(body)]
+        section_sizes = [
+            len(body[m.start() : section_end].encode("utf-8"))
+            for m, section_end in zip(section_matches, section_ends)
+        ]
+        # Account for the marker that replaces the current one, with an upper bound
+        # on its length in case a new archive is written
+        archive_marker = format_archive_marker(
+            max(archive_name, generate_archive_name(file_path), key=len),
+            archived_count + last - first,
+            2**63,
+        )
+        size = (
+            len(text.encode("utf-8"))
+            - len(
+                archive_marker_match.group(0).encode("utf-8")
+                if archive_marker_match
+                else b""
+            )
+            + len(archive_marker.encode("utf-8"))
+            + 2
+        )
+        cut_size = sum(section_sizes[first : turn_starts[turns_to_archive]])
+        while turns_to_archive < len(turn_starts) - 1 and size - cut_size > max_bytes:
+            cut_size += sum(
+                section_sizes[
+                    turn_starts[turns_to_archive] : turn_starts[turns_to_archive + 1]
+                ]
+            )
+            turns_to_archive += 1
+    if turns_to_archive <= 0:
+        return 0
+
+    current_size = (
+        os.path.getsize(archive_path) if os.path.exists(archive_path) else None
+    )
+    if archived_size and (current_size is None or current_size < archived_size):
+        utils.log_warning(
+            f"Archive file {archive_path} is missing or truncated. Skipping archiving."
+        )
+        return 0
+
+    cut_end = turn_starts[turns_to_archive]
+    archived_messages = [
+        {"role": roles[i], "content": str(section_matches[i].group(2) or "").strip()}
+        for i in range(first, cut_end)
+    ]
+    archive_member = gzip.compress(
+        "".join(
+            json.dumps(message, ensure_ascii=False) + "\n"
+            for message in archived_messages
+        ).encode("utf-8")
+    )
+
+    if archive_marker_match and current_size == archived_size:
+        # The archive holds exactly what the marker covers, so append a new gzip member
+        with open(archive_path, "ab") as file:
+            file.write(archive_member)
+            file.flush()
+            os.fsync(file.fileno())
+            archived_size = file.tell()
+    else:
+        # Write a new archive instead of changing one that may be shared with a copy
+        # of the file or hold bytes the marker does not cover
+        archived_data = b""
+        if archived_size:
+            with open(archive_path, "rb") as file:
+                archived_data = file.read(archived_size)
+        archive_name = generate_archive_name(file_path)
+        archive_path = get_archive_path(file_path, archive_name)
+        with open(archive_path, "xb") as file:
+            file.write(archived_data + archive_member)
+            file.flush()
+            os.fsync(file.fileno())
+            archived_size = file.tell()
+
+    remaining_body = (
+        body[: section_matches[first].start()]
+        + body[section_matches[cut_end].start() :]
+    ).lstrip("\n")
+    archive_marker = format_archive_marker(
+        archive_name, archived_count + len(archived_messages), archived_size
+    )
+    text = (
+        (front_matter + "\n" if front_matter else "")
+        + f"{archive_marker}\n\n"
+        + remaining_body
+    )
+
+    # Replace the file atomically so that the marker and the messages kept in the
+    # file always agree with the archive
+    temp_file_path = f"{file_path}.tmp"
+    with open(temp_file_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(temp_file_path, file_path)
+    handle_file_write(file_path)
+
+    return len(archived_messages)
@@ -1,28 +1,60 @@
-from . import completion_handler, file_operations, utils, app_config
-
-import sys, asyncio
+from . import (
+    completion_handler,
+    file_operations,
+    usage_ledger,
+    utils,
+    watcher,
+    app_config,
+)
+
+import os, sys, asyncio
 from termcolor import colored
 
 
 print_response = app_config.get("print_response", True)
 stream_for_file = app_config.get("stream_for_file", True)
+stream_include_usage = app_config.get("stream_include_usage", True)
 model = app_config.get("model", None)
 temperature = app_config.get("temperature", None)
-
-
-async def main():
+record_usage = app_config.get("record_usage", True)
+archive_max_turns = app_config.get("archive_max_turns", None)
+archive_max_bytes = app_config.get("archive_max_bytes", None)
+
+
+def format_stat(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+
+def print_stats():
+    for group_by in ("model", "file"):
+        stats = usage_ledger.aggregate(group_by)
+        print(colored(f"Usage by {group_by}:", "green"))
+        if not stats:
+            print("No records.")
+            continue
+        columns = list(stats[0].keys())
+        rows = [columns] + [[format_stat(s[c]) for c in columns] for s in stats]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+        for row in rows:
+            print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+        print()
+
+
+async def run_chat(file_path: str):
     try:
-        # Validate command-line arguments
-        if len(sys.argv) != 2:
-            raise ValueError("Invalid number of arguments. Expected a file path.")
-        file_path = sys.argv[1]  # Get the file path from command-line arguments
-
         # Initialize configurations
         config = {
             "model": model,
             "temperature": temperature,
             "print_response": print_response,
             "stream_for_file": stream_for_file,
+            "stream_include_usage": stream_include_usage,
+            "archive_max_turns": archive_max_turns,
+            "archive_max_bytes": archive_max_bytes,
         }
 
         # Format the file for a consistent style
@@ -107,12 +139,22 @@ async def main():
             lambda: file_operations.append_heading_to_file(file_path, role="user")
         )
 
+        # Record the usage and latency of the completion in the ledger
+        completion_usage_handlers = []
+        if record_usage:
+            completion_usage_handlers.append(
+                lambda usage_record: usage_ledger.record(
+                    file=os.path.abspath(file_path), **usage_record
+                )
+            )
+
         # Update the configuration with the stream response handlers
         config.update(
             {
                 "stream_response_start_handlers": stream_response_start_handlers,
                 "stream_response_token_handlers": stream_response_token_handlers,
                 "stream_response_end_handlers": stream_response_end_handlers,
+                "completion_usage_handlers": completion_usage_handlers,
             }
         )
 
@@ -121,8 +163,42 @@ async def main():
         response_message = await completion_handler.request_completion(
             messages=messages, config=config
         )
+
+        # Move older messages to the archive to keep the file small
+        # This is done after the completion so that the archive never takes a message the run may remove
+        archived_count = file_operations.archive_old_messages(
+            file_path,
+            max_turns=config.get("archive_max_turns"),
+            max_bytes=config.get("archive_max_bytes"),
+        )
+        if archived_count:
+            print(colored(f"Archived {archived_count} messages.", "green"))
+    except Exception as e:
+        utils.log_error(e)
+    finally:
+        try:
+            usage_ledger.flush()
+        except Exception as e:
+            utils.log_error(e)
+
+
+async def main():
+    try:
+        # Validate command-line arguments
+        if len(sys.argv) == 2 and sys.argv[1] == "stats":
+            print_stats()
+            return
+        if len(sys.argv) == 3 and sys.argv[1] == "watch":
+            await watcher.watch(sys.argv[2], run_chat)
+            return
+        if len(sys.argv) != 2:
+            raise ValueError("Invalid number of arguments. Expected a file path.")
+        file_path = sys.argv[1]  # Get the file path from command-line arguments
     except Exception as e:
         utils.log_error(e)
+        return
+
+    await run_chat(file_path)
 
 
 try:
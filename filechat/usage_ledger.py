@@ -0,0 +1,141 @@
+import os, sqlite3, time, typing
+
+from . import app_config
+
+
+ledger_path = app_config.get("usage_ledger_path", "usage.db")
+
+_buffer: list[dict[str, typing.Any]] = []
+
+_columns = (
+    "timestamp",
+    "file",
+    "model",
+    "prompt_tokens",
+    "completion_tokens",
+    "ttft",
+    "duration",
+    "retries",
+    "cache_hit",
+    "success",
+)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS completions (
+            timestamp REAL NOT NULL,
+            file TEXT,
+            model TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            ttft REAL,
+            duration REAL,
+            retries INTEGER,
+            cache_hit INTEGER,
+            success INTEGER
+        )
+        """
+    )
+    # Ledgers written before `success` was recorded only have successful runs
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(completions)")}
+    if "success" not in columns:
+        connection.execute(
+            "ALTER TABLE completions ADD COLUMN success INTEGER NOT NULL DEFAULT 1"
+        )
+    return connection
+
+
+def record(**fields: typing.Any) -> None:
+    """
+    Buffer a completion record. Records are written to the ledger on `flush`.
+    """
+
+    fields.setdefault("timestamp", time.time())
+    _buffer.append({column: fields.get(column) for column in _columns})
+
+
+def flush(path: str | None = None) -> None:
+    """
+    Append all buffered records to the ledger in a single transaction.
+    """
+
+    if not _buffer:
+        return
+    connection = _connect(path or ledger_path)
+    try:
+        with connection:
+            connection.executemany(
+                "INSERT INTO completions ({}) VALUES ({})".format(
+                    ", ".join(_columns), ", ".join("?" for _ in _columns)
+                ),
+                [tuple(row[column] for column in _columns) for row in _buffer],
+            )
+        _buffer.clear()
+    finally:
+        connection.close()
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """
+    Return the `p`-th percentile (0-100) of the values using linear interpolation.
+    """
+
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def aggregate(
+    group_by: typing.Literal["model", "file"], path: str | None = None
+) -> list[dict[str, typing.Any]]:
+    """
+    Aggregate the ledger by model or file, returning totals and latency percentiles per group.
+
+    Failed runs are counted but excluded from the token totals and latencies.
+    """
+
+    path = path or ledger_path
+    if not os.path.exists(path):
+        return []
+    connection = _connect(path)
+    try:
+        rows = connection.execute(
+            f"SELECT {group_by}, prompt_tokens, completion_tokens, ttft, duration, retries, cache_hit, success "
+            f"FROM completions ORDER BY {group_by}"
+        ).fetchall()
+    finally:
+        connection.close()
+
+    groups: dict[str, list[tuple]] = {}
+    for row in rows:
+        groups.setdefault(str(row[0]), []).append(row[1:])
+
+    stats = []
+    for key, group_rows in groups.items():
+        succeeded_rows = [r for r in group_rows if r[6]]
+        ttfts = [r[2] for r in succeeded_rows if r[2] is not None]
+        durations = [r[3] for r in succeeded_rows if r[3] is not None]
+        stats.append(
+            {
+                group_by: key,
+                "runs": len(group_rows),
+                "failures": len(group_rows) - len(succeeded_rows),
+                "prompt_tokens": sum(r[0] or 0 for r in succeeded_rows),
+                "completion_tokens": sum(r[1] or 0 for r in succeeded_rows),
+                "retries": sum(r[4] or 0 for r in group_rows),
+                "cache_hits": sum(1 for r in succeeded_rows if r[5]),
+                "ttft_p50": percentile(ttfts, 50),
+                "ttft_p95": percentile(ttfts, 95),
+                "duration_p50": percentile(durations, 50),
+                "duration_p95": percentile(durations, 95),
+                "duration_total": sum(durations),
+            }
+        )
+    return stats
@@ -0,0 +1,212 @@
+import asyncio, ctypes, ctypes.util, os, re, struct, sys, typing
+from termcolor import colored
+
+from . import app_config, chat_format, file_operations, utils
+
+
+debounce_seconds = app_config.get("watch_debounce", 0.5)
+poll_interval = app_config.get("watch_poll_interval", 1.0)
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+_inotify_event_header = struct.Struct("iIII")
+
+
+def is_chat_file(path: str) -> bool:
+    return path.endswith(".md")
+
+
+def get_signature(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def needs_completion(file_path: str) -> bool:
+    """
+    Check whether the last section of the file is a non-empty user message.
+    """
+
+    try:
+        with open(file_path, "r", encoding="utf-8") as file:
+            text = file.read()
+    except OSError:
+        return False
+
+    section_pattern = file_operations.get_section_pattern_for_roles(chat_format.roles)
+    last_match = None
+    for last_match in re.finditer(section_pattern, text):
+        pass
+    return (
+        last_match is not None
+        and chat_format.heading_role_map[str(last_match.group(1))] == "user"
+        and str(last_match.group(2) or "").strip() != ""
+    )
+
+
+def _start_inotify(
+    directory: str, on_change: typing.Callable[[str], None]
+) -> typing.Callable[[], None] | None:
+    """
+    Watch the directory tree with inotify and return a function to stop watching,
+    or `None` if inotify is unavailable.
+    """
+
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    watch_dirs: dict[int, str] = {}
+
+    def add_watch(path: str):
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), mask)
+        if wd >= 0:
+            watch_dirs[wd] = path
+
+    for root, _, _ in os.walk(directory):
+        add_watch(root)
+    if not watch_dirs:
+        os.close(fd)
+        return None
+
+    def read_events():
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _inotify_event_header.size <= len(data):
+            wd, event_mask, _, name_length = _inotify_event_header.unpack_from(
+                data, offset
+            )
+            offset += _inotify_event_header.size
+            name = os.fsdecode(data[offset : offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            if wd not in watch_dirs:
+                continue
+            path = os.path.join(watch_dirs[wd], name)
+            if event_mask & IN_ISDIR:
+                if event_mask & (IN_CREATE | IN_MOVED_TO):
+                    add_watch(path)
+            elif event_mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                on_change(path)
+
+    loop = asyncio.get_running_loop()
+    loop.add_reader(fd, read_events)
+
+    def stop():
+        loop.remove_reader(fd)
+        os.close(fd)
+
+    return stop
+
+
+def _scan(directory: str) -> dict[str, tuple[int, int]]:
+    signatures = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if is_chat_file(name):
+                path = os.path.join(root, name)
+                if (signature := get_signature(path)) is not None:
+                    signatures[path] = signature
+    return signatures
+
+
+async def _poll(directory: str, on_change: typing.Callable[[str], None]):
+    signatures = _scan(directory)
+    while True:
+        await asyncio.sleep(poll_interval)
+        new_signatures = _scan(directory)
+        for path, signature in new_signatures.items():
+            if signatures.get(path) != signature:
+                on_change(path)
+        signatures = new_signatures
+
+
+async def watch(
+    directory: str, run_chat: typing.Callable[[str], typing.Awaitable[None]]
+):
+    """
+    Run `run_chat` on chat files in the directory whenever they are saved with a
+    non-empty user message at the end.
+
+    Saves are debounced, each file has at most one run in flight, and saves during
+    a run are coalesced and checked again once the run ends. The file state after each
+    of the tool's own writes is remembered so that they never trigger another run.
+    """
+
+    if not os.path.isdir(directory):
+        raise ValueError(f"Not a directory: {directory}")
+
+    loop = asyncio.get_running_loop()
+    timers: dict[str, asyncio.TimerHandle] = {}
+    running: dict[str, asyncio.Task] = {}
+    pending: set[str] = set()
+    own_signatures: dict[str, tuple[int, int] | None] = {}
+
+    def on_change(path: str):
+        if not is_chat_file(path):
+            return
+        path = os.path.abspath(path)
+        if path in running:
+            # Coalesce saves during a run into a check after the run
+            pending.add(path)
+            return
+        if (timer := timers.pop(path, None)) is not None:
+            timer.cancel()
+        timers[path] = loop.call_later(debounce_seconds, start, path)
+
+    def on_write(path: str):
+        path = os.path.abspath(path)
+        if path in running:
+            own_signatures[path] = get_signature(path)
+
+    def start(path: str):
+        timers.pop(path, None)
+        signature = get_signature(path)
+        if signature is None or signature == own_signatures.get(path):
+            return
+        if not needs_completion(path):
+            return
+        running[path] = loop.create_task(run(path))
+
+    async def run(path: str):
+        print(colored(f"Running on {path}", "green"))
+        try:
+            await run_chat(path)
+        except Exception as e:
+            utils.log_error(e)
+        finally:
+            del running[path]
+            if path in pending:
+                pending.discard(path)
+                on_change(path)
+
+    file_operations.file_write_handlers.append(on_write)
+    stop = _start_inotify(directory, on_change)
+    if stop is None:
+        utils.log_warning("inotify is unavailable. Falling back to polling.")
+    print(colored(f"Watching {os.path.abspath(directory)}...", "green"))
+    try:
+        if stop is None:
+            await _poll(directory, on_change)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        file_operations.file_write_handlers.remove(on_write)
+        if stop is not None:
+            stop()
+        for timer in timers.values():
+            timer.cancel()